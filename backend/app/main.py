@@ -3,15 +3,17 @@ import numpy as np
 import torch
 import os
 import json
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+import secrets
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Header, HTTPException
+from fastapi.responses import PlainTextResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.concurrency import run_in_threadpool
 from datetime import datetime
 from typing import Dict
 
-from .services import llm_service, tts_service
+from .services import llm_service, tts_service, profiling_service
 from .services.stt_service import EnhancedVADAudioProcessor  # ✅ Fixed import
-from .services.llm_service import Agent, set_agent, get_agent, remove_agent
+from .services.llm_service import Agent, set_agent, get_agent, remove_agent, SYSTEM_PROMPT
 from .services.tools.get_weather import get_weather  # ✅ Fixed import
 
 
@@ -24,9 +26,17 @@ CONFIG = {
     "VAD_PADDING_MS": 2100,
     "MIN_SPEECH_DURATION_MS": 300,
     "OUTPUT_DIR": "realtime_audio_output",
-    "LLM_MODEL": "gemini/gemini-2.0-flash"
+    "LLM_MODEL": "gemini/gemini-2.0-flash",
+    "LOOP_MONITOR_INTERVAL_MS": 50,
+    "SLOW_CALLBACK_MS": 100,
+    "PROFILE_DIR": "profiles",
+    "PROFILE_MAX_SECONDS": 60,
+    "PROFILE_MAX_TORCH_CALLS": 20
 }
 
+# Admin/profiling routes are disabled unless ADMIN_TOKEN is set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
 # CREATE THE FASTAPI APP INSTANCE
 app = FastAPI()
 
@@ -52,6 +62,19 @@ def load_models():
     os.makedirs(CONFIG["OUTPUT_DIR"], exist_ok=True)
     print("✅ Server ready")
 
+@app.on_event("startup")
+async def start_profiling():
+    """Start the event-loop lag monitor and slow-callback watchdog."""
+    profiling_service.torch_profiler.output_dir = CONFIG["PROFILE_DIR"]
+    profiling_service.start_loop_monitor(
+        interval=CONFIG["LOOP_MONITOR_INTERVAL_MS"] / 1000,
+        slow_threshold=CONFIG["SLOW_CALLBACK_MS"] / 1000
+    )
+
+@app.on_event("shutdown")
+def stop_profiling():
+    profiling_service.stop_loop_monitor()
+
 # Track active clients
 clients: Dict[WebSocket, EnhancedVADAudioProcessor] = {}
 
@@ -68,17 +91,7 @@ async def websocket_endpoint(websocket: WebSocket):
         name="Chat Assistant",
         model=CONFIG["LLM_MODEL"],
         tools=Tool_list,  # Pass your tools here
-        system_prompt=""" You are a helpful assistant. Keep responses very concise and friendly. 
-IMPORTANT: Use only plain text without any formatting like asterisks, bullets, or special characters. 
-Avoid markdown formatting. Never use phonetic symbols, IPA, or any pronunciation guides. 
-Only use plain English words.
-Keep responses under 50 words.
-
-TOOLS:
-1. WeatherTool: Retrieves the current weather for a specified location.
-    - Usage: get_weather(location)
-    - Param - location (string): The city name for which you want the weather.
-    - The tool returns the current temperature and wind speed for the given location.""",
+        system_prompt=SYSTEM_PROMPT,
         to_break=None,
     )
     set_agent(session_id, agent)
@@ -128,5 +141,63 @@ TOOLS:
 def read_root():
     return {"status": "ok", "message": "Real-time Audio Chat API"}
 
+def check_admin(token):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Admin routes disabled (set ADMIN_TOKEN)")
+    if not secrets.compare_digest(token or "", ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.get("/admin/loop-stats")
+def loop_stats(x_admin_token: str = Header(None)):
+    """Event-loop lag percentiles and recent slow-callback stacks."""
+    check_admin(x_admin_token)
+    if not profiling_service.loop_monitor:
+        return {"status": "monitor not running"}
+    return profiling_service.loop_monitor.stats()
+
+@app.get("/admin/profile")
+async def capture_profile(seconds: float = 10, hz: int = 100, format: str = "speedscope", x_admin_token: str = Header(None)):
+    """
+    Sample all Python thread stacks for `seconds` and return a flame graph file:
+    format=speedscope (open in speedscope.app) or format=collapsed (flamegraph.pl).
+    """
+    check_admin(x_admin_token)
+    if format not in ("speedscope", "collapsed"):
+        raise HTTPException(status_code=400, detail="format must be 'speedscope' or 'collapsed'")
+    if not 0 < seconds <= CONFIG["PROFILE_MAX_SECONDS"] or not 1 <= hz <= 1000:
+        raise HTTPException(status_code=400, detail="seconds or hz out of range")
+    if profiling_service.sampling_profiler.busy:
+        raise HTTPException(status_code=409, detail="A profile capture is already running")
+
+    # Sampling blocks its thread for the whole capture, so keep it off the event loop
+    try:
+        profile = await run_in_threadpool(profiling_service.sampling_profiler.capture, seconds, hz)
+    except RuntimeError:
+        # Lost the race with a concurrent request that passed the busy check too
+        raise HTTPException(status_code=409, detail="A profile capture is already running")
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    if format == "collapsed":
+        return PlainTextResponse(
+            profiling_service.to_collapsed(profile),
+            headers={"Content-Disposition": f'attachment; filename="profile_{stamp}.collapsed.txt"'}
+        )
+    return JSONResponse(
+        profiling_service.to_speedscope(profile, name=f"profile_{stamp}"),
+        headers={"Content-Disposition": f'attachment; filename="profile_{stamp}.speedscope.json"'}
+    )
+
+@app.post("/admin/torch-profile")
+def arm_torch_profile(count: int = 1, x_admin_token: str = Header(None)):
+    """Run torch.profiler around the next `count` Whisper transcriptions; traces go to PROFILE_DIR."""
+    check_admin(x_admin_token)
+    if not 1 <= count <= CONFIG["PROFILE_MAX_TORCH_CALLS"]:
+        raise HTTPException(status_code=400, detail="count out of range")
+    profiling_service.torch_profiler.arm(count)
+    return {
+        "armed": count,
+        "output_dir": CONFIG["PROFILE_DIR"],
+        "recent_traces": list(profiling_service.torch_profiler.traces)
+    }
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -1,51 +1,458 @@
-from typing import Any, Dict
+import argparse
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from math import gcd
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import torch
+import whisper
+from scipy.io import wavfile
+from scipy.signal import resample_poly
+
+from .services.api_tts_service import process_api_tts
+from .services.llm_service import Agent, SYSTEM_PROMPT, process_llm
+from .services.profiling_service import torch_profiler
+from .services.stt_service import clean_text_for_tts
+from .services.tools.get_weather import get_weather
+
+# Whisper pads/trims every input to a 30 second window; clips up to this
+# length can be stacked into one mel batch and decoded together.
+WHISPER_WINDOW_SECONDS = 30.0
+
+# Same silence and quality rules whisper.transcribe applies by default
+NO_SPEECH_THRESHOLD = 0.6
+LOGPROB_THRESHOLD = -1.0
+COMPRESSION_RATIO_THRESHOLD = 2.4
+
+# Threads that read WAVs ahead of the decoder; loading is cheap next to STT
+LOAD_WORKERS = 2
+
+
+def collect_audio_files(source: str) -> List[str]:
+    """
+    Returns the WAV files to process, either from a directory (sorted by name)
+    or from a manifest. A manifest is a .jsonl file with a "path" or
+    "audio_file" key per line, or a plain text file with one path per line.
+    Relative manifest entries are resolved against the manifest's directory.
+    Malformed manifest lines are reported and skipped.
+    """
+    if os.path.isdir(source):
+        return sorted(
+            os.path.join(source, name)
+            for name in os.listdir(source)
+            if name.lower().endswith(".wav")
+        )
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    is_jsonl = source.lower().endswith(".jsonl")
+    paths = []
+    with open(source, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if is_jsonl:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"⚠️ Skipping malformed manifest line {line_no}")
+                    continue
+                line = entry.get("path") or entry.get("audio_file") if isinstance(entry, dict) else None
+                if not line:
+                    print(f"⚠️ Skipping manifest line {line_no}: no \"path\" or \"audio_file\"")
+                    continue
+            paths.append(line if os.path.isabs(line) else os.path.join(base_dir, line))
+    return paths
+
+
+def wav_duration(path: str) -> float:
+    """Reads the clip length from the WAV header without loading the samples."""
+    try:
+        with wave.open(path, "rb") as w:
+            return w.getnframes() / float(w.getframerate())
+    except (wave.Error, EOFError, OSError):
+        pass
+    try:
+        # Non-PCM or odd headers: file size is still a fine sort key
+        return os.path.getsize(path) / 32000.0
+    except OSError:
+        # Missing/unreadable: sort it anywhere and let load() record the error
+        return 0.0
+
+
+def load_wav(path: str, sample_rate: int) -> np.ndarray:
+    """Loads a WAV file as mono float32 in [-1, 1] at the given sample rate."""
+    file_rate, data = wavfile.read(path)
+    if data.dtype == np.int16:
+        audio = data.astype(np.float32) / 32768.0
+    elif data.dtype == np.int32:
+        audio = data.astype(np.float32) / 2147483648.0
+    elif data.dtype == np.uint8:
+        audio = (data.astype(np.float32) - 128.0) / 128.0
+    else:
+        audio = data.astype(np.float32)
+    if audio.ndim > 1:
+        audio = audio.mean(axis=1)
+    if file_rate != sample_rate:
+        g = gcd(file_rate, sample_rate)
+        audio = resample_poly(audio, sample_rate // g, file_rate // g).astype(np.float32)
+    return audio
+
+
+def bucket_by_length(paths: List[str], batch_size: int) -> List[List[str]]:
+    """
+    Groups clips of similar duration into batches. Batched decoding runs until
+    the longest transcript in the batch finishes, so mixing short and long
+    utterances wastes decoder steps on the short ones.
+    """
+    ordered = sorted(paths, key=wav_duration)
+    return [ordered[i:i + batch_size] for i in range(0, len(ordered), batch_size)]
+
+
+def load_completed(output_path: str) -> set:
+    """
+    Returns the audio paths that already have a successful record in the
+    output JSONL. Failed records and a truncated last line (from an
+    interrupted run) are not counted, so those clips are retried.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(record, dict) and record.get("path") and not record.get("error"):
+                done.add(record["path"])
+    return done
+
+
+def default_agent_factory(config: Dict) -> Callable[[], Agent]:
+    """Builds a fresh agent per utterance so batch results don't share history."""
+    def factory():
+        return Agent(
+            name="Batch Assistant",
+            model=config["LLM_MODEL"],
+            tools=[get_weather],
+            system_prompt=SYSTEM_PROMPT,
+            to_break=None,
+        )
+    return factory
 
-from .services import stt_service, llm_service, tts_service 
 
 class AudioPipeline:
-    def __init__(self, config: Dict, stt_model: Any):
-        """Initializes the pipeline with config and the STT model."""
+    def __init__(self, config: Dict, stt_model: Any, agent_factory: Optional[Callable[[], Agent]] = None):
+        """Initializes the pipeline with config and the STT (Whisper) model."""
         self.config = config
         self.stt_model = stt_model
-        self.model_type = config.get("ACTIVE_MODEL")
+        self.agent_factory = agent_factory or default_agent_factory(config)
+        # Whisper installs kv-cache hooks on the shared model while decoding,
+        # so STT calls must not overlap; LLM/TTS calls run freely in parallel.
+        self._stt_lock = threading.Lock()
+
+    def transcribe(self, audio: np.ndarray) -> str:
+        """Transcribes a single clip of any length with whisper.transcribe."""
+        with self._stt_lock, torch_profiler.profile("batch_transcribe"):
+            result = self.stt_model.transcribe(audio.astype(np.float32), fp16=torch.cuda.is_available())
+        return result.get("text", "").strip()
+
+    def transcribe_batch(self, audios: List[np.ndarray]) -> List[str]:
+        """
+        Transcribes several clips in one forward pass. Clips longer than the
+        Whisper window can't be stacked and fall back to transcribe().
+
+        The batched pass is a single greedy decode, so clips that fail
+        whisper.transcribe's quality checks (repetition loops show up as a high
+        compression ratio, or a low average logprob) are re-run through
+        transcribe(), whose temperature fallback keeps output comparable with
+        the live server.
+        """
+        texts = [""] * len(audios)
+        window_samples = int(WHISPER_WINDOW_SECONDS * self.config["SAMPLE_RATE"])
+        short_idx = [i for i, a in enumerate(audios) if len(a) <= window_samples]
+
+        for i, audio in enumerate(audios):
+            if len(audio) > window_samples:
+                texts[i] = self.transcribe(audio)
+
+        if short_idx:
+            n_mels = self.stt_model.dims.n_mels
+            mel = torch.stack([
+                whisper.log_mel_spectrogram(whisper.pad_or_trim(audios[i].astype(np.float32)), n_mels)
+                for i in short_idx
+            ]).to(self.stt_model.device)
+            options = whisper.DecodingOptions(fp16=torch.cuda.is_available(), without_timestamps=True)
+            with self._stt_lock, torch_profiler.profile("batch_decode"):
+                results = whisper.decode(self.stt_model, mel, options)
+            for i, result in zip(short_idx, results):
+                if result.no_speech_prob > NO_SPEECH_THRESHOLD and result.avg_logprob < LOGPROB_THRESHOLD:
+                    continue
+                if result.compression_ratio > COMPRESSION_RATIO_THRESHOLD or result.avg_logprob < LOGPROB_THRESHOLD:
+                    texts[i] = self.transcribe(audios[i])
+                else:
+                    texts[i] = result.text.strip()
+        return texts
+
+    def respond(self, text: str, with_tts: bool = False) -> Dict:
+        """Runs the LLM (and optionally TTS) for one transcript, same as a live session."""
+        llm_response = process_llm(self.agent_factory(), text)
+        if isinstance(llm_response, list):
+            llm_response = ' '.join(llm_response)
+        llm_response = str(llm_response) if llm_response is not None else ""
+        output = {"llm": llm_response}
+        if with_tts:
+            text_for_tts = clean_text_for_tts(llm_response.replace('\n', ' ').strip())
+            output["tts"] = process_api_tts(text_for_tts)
+        return output
+
+    def complete_record(self, record: Dict, with_tts: bool = False, tts_dir: Optional[str] = None) -> Dict:
+        """
+        Adds the LLM (and TTS) output for a transcribed batch record in place.
+        Empty LLM content or TTS audio is marked as an error so a resumed run
+        retries the clip instead of counting it as done.
+        """
+        record.update(self.respond(record["stt"], with_tts=with_tts))
+        if not record["llm"].strip():
+            record["error"] = "LLM returned no content"
+        elif with_tts:
+            tts_audio = record.pop("tts")
+            if tts_audio:
+                # Path hash keeps same-named clips from different directories apart
+                path_hash = hashlib.sha1(record["path"].encode("utf-8")).hexdigest()[:8]
+                name = f"{os.path.splitext(record['audio_file'])[0]}_{path_hash}.mp3"
+                with open(os.path.join(tts_dir, name), "wb") as f:
+                    f.write(base64.b64decode(tts_audio))
+                record["tts_file"] = name
+            else:
+                record["error"] = "TTS returned no audio"
+        record.pop("tts", None)
+        return record
 
     def run(self, raw_audio_bytes: bytes) -> Dict:
-        """Executes the pipeline and returns a dictionary with text results from each step."""
+        """Executes the pipeline on raw 16-bit PCM and returns the text results from each step."""
         print("\n--- Starting Audio Processing Pipeline ---")
-        
+
         results = {
             "stt_output": "",
             "llm_output": "",
-            "chatterbox_output": "",
+            "tts_output": "",
             "error": None
         }
 
         try:
             # Step 1: Speech-to-Text
-            transcribed_text = stt_service.transcribe_audio_service(
-                model=self.stt_model,
-                model_type=self.model_type,
-                sample_rate=self.config["SAMPLE_RATE"],
-                audio_data=raw_audio_bytes
-            )
+            audio_np = np.frombuffer(raw_audio_bytes, dtype=np.int16).astype(np.float32) / 32768.0
+            transcribed_text = self.transcribe(audio_np)
             results["stt_output"] = transcribed_text or "(No speech detected)"
             if not transcribed_text:
                 results["llm_output"] = "(Pipeline stopped: No STT output)"
-                results["chatterbox_output"] = "(Pipeline stopped: No STT output)"
+                results["tts_output"] = "(Pipeline stopped: No STT output)"
                 return results
 
-            # Step 2: LLM Processing
-            llm_agent = llm_service.get_global_agent()
-            llm_text_output = llm_service.process_llm(llm_agent, transcribed_text)
-            results["llm_output"] = llm_text_output
+            # Step 2 + 3: LLM and TTS
+            response = self.respond(transcribed_text, with_tts=True)
+            results["llm_output"] = response["llm"]
+            results["tts_output"] = response["tts"]
 
-            # Step 3: Chatterbox
-            chatterbox_text_output = tts_service.process_chatterbox(llm_text_output)
-            results["chatterbox_output"] = chatterbox_text_output
-        
         except Exception as e:
             print(f"ERROR: Pipeline failed. {e}")
             results["error"] = str(e)
 
         print("--- Pipeline Finished ---")
-        return results
\ No newline at end of file
+        return results
+
+    def run_batch(
+        self,
+        source: str,
+        output_path: str,
+        with_llm: bool = False,
+        with_tts: bool = False,
+        batch_size: int = 8,
+        workers: int = 4,
+        tts_dir: Optional[str] = None,
+    ) -> Dict:
+        """
+        Streams every WAV in `source` (directory or manifest) through STT and
+        optionally LLM/TTS, appending one JSON record per clip to `output_path`
+        as soon as it finishes. Clips already recorded in `output_path` are
+        skipped, so an interrupted run picks up where it stopped.
+
+        Audio is prefetched on its own small pool so STT never queues behind
+        LLM/TTS calls, which run on `workers` threads. At most `workers * 4`
+        clips wait for the LLM at once; beyond that STT pauses. STT runs in
+        length-bucketed batches of `batch_size`. Returns throughput stats.
+        """
+        with_llm = with_llm or with_tts
+        sample_rate = self.config["SAMPLE_RATE"]
+        paths = [os.path.abspath(p) for p in collect_audio_files(source)]
+        done = load_completed(output_path)
+        pending = [p for p in paths if p not in done]
+        print(f"📂 {len(paths)} files, {len(paths) - len(pending)} already done, {len(pending)} to process")
+
+        if with_tts:
+            tts_dir = tts_dir or os.path.splitext(output_path)[0] + "_tts"
+            os.makedirs(tts_dir, exist_ok=True)
+        out_dir = os.path.dirname(os.path.abspath(output_path))
+        os.makedirs(out_dir, exist_ok=True)
+
+        stats = {"files": 0, "errors": 0, "audio_seconds": 0.0, "stt_seconds": 0.0}
+        write_lock = threading.Lock()
+        started = time.perf_counter()
+
+        # Never glue a new record onto a line cut off by an interruption
+        if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+            with open(output_path, "rb+") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+
+        with open(output_path, "a", encoding="utf-8") as out:
+
+            def write_record(record: Dict):
+                with write_lock:
+                    out.write(json.dumps(record) + "\n")
+                    out.flush()
+                    stats["files"] += 1
+                    if record.get("error"):
+                        stats["errors"] += 1
+
+            def finish(record: Dict):
+                try:
+                    self.complete_record(record, with_tts=with_tts, tts_dir=tts_dir)
+                except Exception as e:
+                    record["error"] = str(e)
+                finally:
+                    backlog.release()
+                write_record(record)
+
+            def load(path):
+                try:
+                    return load_wav(path, sample_rate)
+                except Exception as e:
+                    return e
+
+            loader = ThreadPoolExecutor(max_workers=LOAD_WORKERS, thread_name_prefix="batch-load")
+            pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch-llm")
+            # Bounds clips waiting on the LLM so a slow API can't queue the whole run in memory
+            backlog = threading.BoundedSemaphore(workers * 4)
+            try:
+                downstream = []
+                batches = bucket_by_length(pending, batch_size)
+                # Prefetch the next batch from disk while the current one decodes
+                next_loads = [loader.submit(load, p) for p in batches[0]] if batches else []
+
+                for n, batch in enumerate(batches):
+                    loaded = [f.result() for f in next_loads]
+                    if n + 1 < len(batches):
+                        next_loads = [loader.submit(load, p) for p in batches[n + 1]]
+
+                    ok = [(p, a) for p, a in zip(batch, loaded) if not isinstance(a, Exception)]
+                    for p, a in zip(batch, loaded):
+                        if isinstance(a, Exception):
+                            write_record({"path": p, "audio_file": os.path.basename(p), "error": str(a)})
+                    if not ok:
+                        continue
+
+                    stt_start = time.perf_counter()
+                    try:
+                        texts = self.transcribe_batch([a for _, a in ok])
+                        error = None
+                    except Exception as e:
+                        texts, error = [""] * len(ok), str(e)
+                    stt_elapsed = time.perf_counter() - stt_start
+                    stats["stt_seconds"] += stt_elapsed
+
+                    for (path, audio), text in zip(ok, texts):
+                        duration = len(audio) / float(sample_rate)
+                        stats["audio_seconds"] += duration
+                        record = {
+                            "path": path,
+                            "audio_file": os.path.basename(path),
+                            "duration_s": round(duration, 3),
+                            "stt": text,
+                            "stt_batch_ms": round(stt_elapsed * 1000, 1),
+                        }
+                        if error:
+                            record["error"] = error
+                            write_record(record)
+                        elif with_llm and text:
+                            backlog.acquire()
+                            downstream.append(pool.submit(finish, record))
+                        else:
+                            write_record(record)
+
+                    # Surface finished LLM/TTS tasks' errors and drop them from the list
+                    finished = [f for f in downstream if f.done()]
+                    for f in finished:
+                        f.result()
+                    downstream = [f for f in downstream if f not in finished]
+
+                    print(f"🧮 Batch {n + 1}/{len(batches)}: {len(ok)} clips in {stt_elapsed:.2f}s")
+
+                for f in downstream:
+                    f.result()
+            except BaseException:
+                # On Ctrl-C drop queued LLM/TTS calls (only in-flight ones finish); a rerun resumes the rest
+                loader.shutdown(cancel_futures=True)
+                pool.shutdown(cancel_futures=True)
+                raise
+            loader.shutdown()
+            pool.shutdown()
+
+        wall = time.perf_counter() - started
+        stats["wall_seconds"] = round(wall, 3)
+        stats["stt_seconds"] = round(stats["stt_seconds"], 3)
+        stats["audio_seconds"] = round(stats["audio_seconds"], 3)
+        # Real-time factor: processing time per second of audio (lower is faster)
+        stats["stt_rtf"] = round(stats["stt_seconds"] / stats["audio_seconds"], 4) if stats["audio_seconds"] else None
+        stats["files_per_second"] = round(stats["files"] / wall, 3) if wall > 0 else None
+        print(f"✅ Batch finished: {json.dumps(stats)}")
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline batch transcription over a directory or manifest of WAV files.")
+    parser.add_argument("source", help="Directory of .wav files, or a .jsonl/.txt manifest")
+    parser.add_argument("--out", default="batch_results.jsonl", help="Output JSONL (appended to; reruns resume)")
+    parser.add_argument("--model", default="tiny.en", help="Whisper model name")
+    parser.add_argument("--sample-rate", type=int, default=16000)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=4, help="Threads for audio loading and LLM/TTS calls")
+    parser.add_argument("--llm", action="store_true", help="Also run each transcript through the LLM")
+    parser.add_argument("--tts", action="store_true", help="Also synthesize the LLM response (implies --llm)")
+    parser.add_argument("--tts-dir", default=None, help="Where to write TTS audio (default: <out>_tts/)")
+    parser.add_argument("--llm-model", default="gemini/gemini-2.0-flash")
+    args = parser.parse_args()
+
+    config = {
+        "SAMPLE_RATE": args.sample_rate,
+        "WHISPER_MODEL_NAME": args.model,
+        "LLM_MODEL": args.llm_model,
+    }
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"Loading Whisper '{args.model}' on {device}...")
+    model = whisper.load_model(args.model, device=device)
+
+    pipeline = AudioPipeline(config, model)
+    pipeline.run_batch(
+        args.source,
+        args.out,
+        with_llm=args.llm,
+        with_tts=args.tts,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        tts_dir=args.tts_dir,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+import asyncio
+import collections
+import contextlib
+import os
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import torch
+
+
+class LoopMonitor:
+    """
+    Low-overhead event-loop health monitor for one asyncio loop.
+
+    - Lag: a coroutine sleeps `interval` and measures how late it wakes up.
+    - Slow callbacks: a watchdog thread watches the coroutine's heartbeat and,
+      once the loop has been stuck longer than `slow_threshold`, grabs the loop
+      thread's stack so the blocking code (e.g. a sync file write or a big
+      json.dumps) shows up by name. Works under uvloop, unlike patching
+      asyncio Handle._run or loop.set_debug().
+    """
+
+    def __init__(self, interval: float = 0.05, slow_threshold: float = 0.1, history: int = 50):
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self.slow_callbacks = collections.deque(maxlen=history)
+        self.lag_samples = collections.deque(maxlen=1200)
+        self.max_lag = 0.0
+        self._heartbeat = time.perf_counter()
+        # (heartbeat, entry) of a stall the watchdog reported but the loop hasn't recovered from yet
+        self._open_stall = None
+        # (heartbeat, lag) of the last wake-up that came in over slow_threshold
+        self._last_stall = None
+        self._loop_thread_id = None
+        self._task = None
+        self._watchdog = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Starts monitoring the running loop. Must be called from inside the loop."""
+        loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.perf_counter()
+        self._stop.clear()
+        self._task = loop.create_task(self._measure_lag())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _measure_lag(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            lag = max(0.0, now - expected)
+            if lag >= self.slow_threshold:
+                # Published before checking _open_stall; _watch does the reverse, so
+                # whichever side runs second fills in the full stall duration
+                self._last_stall = (self._heartbeat, lag)
+            open_stall = self._open_stall
+            if open_stall and open_stall[0] == self._heartbeat:
+                self._close_stall(open_stall[1], lag)
+            self._heartbeat = now
+            self.lag_samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+    def _watch(self):
+        reported_for = None
+        while not self._stop.wait(self.interval):
+            heartbeat = self._heartbeat
+            stalled = time.perf_counter() - heartbeat - self.interval
+            if stalled < self.slow_threshold or reported_for == heartbeat:
+                continue
+            # One report per stall: the stack is taken while the loop is still blocked
+            reported_for = heartbeat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = traceback.format_stack(frame) if frame else []
+            entry = {
+                "time": datetime.now().isoformat(timespec="milliseconds"),
+                "detected_after_ms": round(stalled * 1000, 1),
+                # Overwritten with the full stall duration once the loop wakes up
+                "blocked_ms": None,
+                "stack": [line.strip() for line in stack[-12:]],
+            }
+            self._open_stall = (heartbeat, entry)
+            self.slow_callbacks.append(entry)
+            print(f"🐢 Event loop blocked >{stalled * 1000:.0f}ms at: {stack[-1].strip() if stack else '?'}")
+            last_stall = self._last_stall
+            if last_stall and last_stall[0] == heartbeat:
+                # The loop woke up while the stack was being taken
+                self._close_stall(entry, last_stall[1])
+
+    def _close_stall(self, entry: Dict, lag: float):
+        """The watchdog only sees the start of a stall; record how long it really lasted."""
+        if entry["blocked_ms"] is None:
+            entry["blocked_ms"] = round(lag * 1000, 1)
+            print(f"🐢 Event loop was blocked {lag * 1000:.0f}ms in total")
+        self._open_stall = None
+
+    def stats(self) -> Dict:
+        samples = sorted(self.lag_samples)
+        def pct(p):
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 2) if samples else None
+        return {
+            "interval_ms": self.interval * 1000,
+            "slow_threshold_ms": self.slow_threshold * 1000,
+            "lag_ms": {"p50": pct(0.5), "p99": pct(0.99), "max": round(self.max_lag * 1000, 2)},
+            "threads": threading.active_count(),
+            "torch_threads": torch.get_num_threads(),
+            "switch_interval_ms": sys.getswitchinterval() * 1000,
+            "slow_callbacks": list(self.slow_callbacks),
+        }
+
+
+class SamplingProfiler:
+    """
+    Wall-clock sampling profiler over all Python threads using
+    sys._current_frames(). Native torch threads have no Python frames; their
+    cost shows up as time spent inside the calling Python frame.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    def capture(self, seconds: float, hz: int = 100) -> Dict:
+        """
+        Samples every thread's stack `hz` times per second for `seconds`.
+        Blocks the calling thread, so run it off the event loop.
+        Returns {"duration", "interval", "samples", "threads": {name: Counter(stack tuple -> count)}}.
+        `samples` is the number of sampling passes actually taken in `duration`.
+        """
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("A profile capture is already running")
+        try:
+            interval = 1.0 / hz
+            own_id = threading.get_ident()
+            threads: Dict[str, collections.Counter] = collections.defaultdict(collections.Counter)
+            started = time.perf_counter()
+            deadline = started + seconds
+            samples = 0
+            while time.perf_counter() < deadline:
+                samples += 1
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_id:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append((code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                        frame = frame.f_back
+                    stack.reverse()
+                    threads[names.get(thread_id, str(thread_id))][tuple(stack)] += 1
+                time.sleep(interval)
+            return {
+                "duration": time.perf_counter() - started,
+                "interval": interval,
+                "samples": samples,
+                "threads": threads,
+            }
+        finally:
+            self._lock.release()
+
+
+def to_collapsed(profile: Dict) -> str:
+    """Brendan Gregg collapsed-stack format, one line per unique stack (flamegraph.pl, speedscope)."""
+    lines = []
+    for thread_name, stacks in profile["threads"].items():
+        for stack, count in stacks.items():
+            frames = [thread_name.replace(";", ":")] + [f"{name} ({file}:{line})" for name, file, line in stack]
+            lines.append(f"{';'.join(frames)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def to_speedscope(profile: Dict, name: str = "live-session") -> Dict:
+    """speedscope.app "sampled" file format, one profile per thread."""
+    # Walking every thread's stack stretches each pass past the nominal interval,
+    # so weight samples by the measured period to keep totals equal to wall time
+    period = profile["duration"] / profile["samples"] if profile["samples"] else profile["interval"]
+    frames: List[Dict] = []
+    frame_index: Dict[tuple, int] = {}
+    profiles = []
+    for thread_name, stacks in profile["threads"].items():
+        samples, weights = [], []
+        for stack, count in stacks.items():
+            indices = []
+            for frame in stack:
+                if frame not in frame_index:
+                    frame_index[frame] = len(frames)
+                    frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+                indices.append(frame_index[frame])
+            samples.append(indices)
+            weights.append(count * period)
+        profiles.append({
+            "type": "sampled",
+            "name": thread_name,
+            "unit": "seconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights,
+        })
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": name,
+        "exporter": "profiling_service",
+        "shared": {"frames": frames},
+        "profiles": profiles,
+    }
+
+
+class TorchProfilerHook:
+    """
+    Wraps Whisper calls in torch.profiler when armed. Unarmed it is a
+    nullcontext, so the live path pays nothing until an admin arms it for
+    the next N transcriptions.
+    """
+
+    def __init__(self, output_dir: str = "profiles"):
+        self.output_dir = output_dir
+        self._remaining = 0
+        self._lock = threading.Lock()
+        # torch.profiler is process-global and sessions can't overlap, so
+        # concurrent transcriptions only get profiled one at a time
+        self._active = threading.Lock()
+        self.traces = collections.deque(maxlen=20)
+
+    def arm(self, count: int):
+        with self._lock:
+            self._remaining = count
+
+    def _take(self) -> bool:
+        with self._lock:
+            if self._remaining <= 0:
+                return False
+            self._remaining -= 1
+            return True
+
+    def profile(self, label: str):
+        """Context manager to put around whisper_model.transcribe."""
+        if not self._remaining or not self._active.acquire(blocking=False):
+            return contextlib.nullcontext()
+        if not self._take():
+            self._active.release()
+            return contextlib.nullcontext()
+        return self._profile(label)
+
+    @contextlib.contextmanager
+    def _profile(self, label: str):
+        """
+        Runs with self._active held (acquired in profile()) and releases it.
+        Profiler failures are logged and never reach the wrapped transcription,
+        and the trace is exported on a background thread off the request path.
+        """
+        stack = contextlib.ExitStack()
+        prof = None
+        try:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            prof = stack.enter_context(torch.profiler.profile(activities=activities))
+            stack.enter_context(torch.profiler.record_function(label))
+        except Exception as e:
+            print(f"❌ Torch profiler failed to start [{label}]: {e}")
+            stack.close()
+            prof = None
+        try:
+            yield
+        finally:
+            try:
+                stack.close()
+            except Exception as e:
+                print(f"❌ Torch profiler failed to stop [{label}]: {e}")
+                prof = None
+            self._active.release()
+        if prof is not None:
+            threading.Thread(target=self._export, args=(prof, label), name="torch-profile-export", daemon=True).start()
+
+    def _export(self, prof, label: str):
+        """Writes the chrome trace plus a key_averages table next to it."""
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            base = f"torch_{label}_{datetime.now().strftime('%H%M%S_%f')}"
+            path = os.path.join(self.output_dir, base + ".json")
+            prof.export_chrome_trace(path)
+            sort_by = "cuda_time_total" if torch.cuda.is_available() else "cpu_time_total"
+            with open(os.path.join(self.output_dir, base + ".txt"), "w", encoding="utf-8") as f:
+                f.write(prof.key_averages().table(sort_by=sort_by, row_limit=20))
+            self.traces.append(base + ".json")
+            print(f"🔥 Torch profile [{label}] -> {path}")
+        except Exception as e:
+            print(f"❌ Torch profile export failed [{label}]: {e}")
+
+
+# Process-wide instances shared by the app, STT service and batch pipeline
+loop_monitor: Optional[LoopMonitor] = None
+sampling_profiler = SamplingProfiler()
+torch_profiler = TorchProfilerHook()
+
+
+def start_loop_monitor(interval: float, slow_threshold: float) -> LoopMonitor:
+    global loop_monitor
+    loop_monitor = LoopMonitor(interval=interval, slow_threshold=slow_threshold)
+    loop_monitor.start()
+    return loop_monitor
+
+
+def stop_loop_monitor():
+    if loop_monitor:
+        loop_monitor.stop()
@@ -10,6 +10,7 @@ from scipy.io.wavfile import write as write_wav
 from typing import Tuple, Optional
 from fastapi.concurrency import run_in_threadpool
 from .api_tts_service import process_api_tts
+from .profiling_service import torch_profiler
 
 
 def clean_text_for_tts(text):
@@ -127,10 +128,11 @@ class EnhancedVADAudioProcessor:
 
             # 2. Transcribe with Whisper (runs in threadpool for async compatibility)
             def transcribe_audio():
-                return self.whisper_model.transcribe(
-                    full_audio_np.astype(np.float32),
-                    fp16=torch.cuda.is_available()
-                )
+                with torch_profiler.profile(f"transcribe_{self.session_id}"):
+                    return self.whisper_model.transcribe(
+                        full_audio_np.astype(np.float32),
+                        fp16=torch.cuda.is_available()
+                    )
             result = await run_in_threadpool(transcribe_audio)
             transcribed_text = result.get("text", "").strip()
             print(f"[DEBUG] Transcript: '{transcribed_text}' (len={len(transcribed_text)})")
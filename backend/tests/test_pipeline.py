@@ -0,0 +1,191 @@
+import json
+import os
+import wave
+
+import pytest
+
+from app import pipeline as pipeline_module
+from app.pipeline import AudioPipeline, bucket_by_length, collect_audio_files, load_completed
+
+SAMPLE_RATE = 16000
+
+
+def write_wav(path, seconds):
+    with wave.open(str(path), "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+        w.writeframes(b"\x00\x00" * int(seconds * SAMPLE_RATE))
+    return str(path)
+
+
+def read_records(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class StubAgent:
+    def __init__(self, reply):
+        self.reply = reply
+
+    def invoke(self, message):
+        return self.reply
+
+
+def make_pipeline(reply="hello back", texts_for=None):
+    """AudioPipeline with the Whisper model and LLM agent stubbed out."""
+    pipeline = AudioPipeline(
+        {"SAMPLE_RATE": SAMPLE_RATE, "LLM_MODEL": "stub"},
+        stt_model=object(),
+        agent_factory=lambda: StubAgent(reply),
+    )
+    pipeline.transcribe_batch = lambda audios: [texts_for(a) if texts_for else "hello" for a in audios]
+    return pipeline
+
+
+def test_collect_audio_files_directory(tmp_path):
+    write_wav(tmp_path / "b.wav", 0.1)
+    write_wav(tmp_path / "a.WAV", 0.1)
+    (tmp_path / "notes.txt").write_text("x")
+
+    assert collect_audio_files(str(tmp_path)) == [str(tmp_path / "a.WAV"), str(tmp_path / "b.wav")]
+
+
+def test_collect_audio_files_jsonl_manifest_skips_bad_lines(tmp_path):
+    manifest = tmp_path / "manifest.JSONL"
+    manifest.write_text("\n".join([
+        json.dumps({"path": "clips/one.wav"}),
+        "{not json",
+        json.dumps(["not", "a", "dict"]),
+        json.dumps({"other": "key"}),
+        json.dumps({"audio_file": "/abs/two.wav"}),
+    ]) + "\n")
+
+    assert collect_audio_files(str(manifest)) == [str(tmp_path / "clips" / "one.wav"), "/abs/two.wav"]
+
+
+def test_collect_audio_files_text_manifest(tmp_path):
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_text("# comment\none.wav\n\n/abs/two.wav\n")
+
+    assert collect_audio_files(str(manifest)) == [str(tmp_path / "one.wav"), "/abs/two.wav"]
+
+
+def test_bucket_by_length_groups_by_duration_and_tolerates_missing_files(tmp_path):
+    long_clip = write_wav(tmp_path / "long.wav", 1.0)
+    short_clip = write_wav(tmp_path / "short.wav", 0.1)
+    mid_clip = write_wav(tmp_path / "mid.wav", 0.5)
+    missing = str(tmp_path / "missing.wav")
+
+    assert bucket_by_length([long_clip, short_clip, missing, mid_clip], 2) == [
+        [missing, short_clip],
+        [mid_clip, long_clip],
+    ]
+
+
+def test_load_completed_only_counts_successful_records(tmp_path):
+    out = tmp_path / "results.jsonl"
+    out.write_text("\n".join([
+        json.dumps({"path": "/ok.wav", "stt": "hi"}),
+        json.dumps({"path": "/failed.wav", "error": "boom"}),
+        json.dumps({"no_path": True}),
+        json.dumps([1, 2]),
+        '{"path": "/truncated.wav", "st',
+    ]))
+
+    assert load_completed(str(out)) == {"/ok.wav"}
+    assert load_completed(str(tmp_path / "missing.jsonl")) == set()
+
+
+def test_run_batch_resumes_after_interruption(tmp_path):
+    clips = tmp_path / "clips"
+    clips.mkdir()
+    done_clip = write_wav(clips / "done.wav", 0.2)
+    failed_clip = write_wav(clips / "failed.wav", 0.2)
+    cut_clip = write_wav(clips / "cut.wav", 0.2)
+    new_clip = write_wav(clips / "new.wav", 0.2)
+
+    out = tmp_path / "results.jsonl"
+    # Previous run: one success, one failure, and a record cut off mid-write
+    out.write_text(
+        json.dumps({"path": done_clip, "stt": "old"}) + "\n"
+        + json.dumps({"path": failed_clip, "error": "boom"}) + "\n"
+        + '{"path": "' + cut_clip + '", "st'
+    )
+
+    stats = make_pipeline().run_batch(str(clips), str(out), batch_size=2, workers=2)
+
+    assert stats["files"] == 3
+    with open(out, "r", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    # The truncated line stays on its own line and every new record is valid JSON
+    assert lines[2] == '{"path": "' + cut_clip + '", "st'
+    new_records = [json.loads(line) for line in lines[3:]]
+    assert sorted(r["path"] for r in new_records) == sorted([failed_clip, cut_clip, new_clip])
+    assert all(r["stt"] == "hello" and "error" not in r for r in new_records)
+
+    # Everything is done now, so a rerun does no work
+    assert make_pipeline().run_batch(str(clips), str(out))["files"] == 0
+
+
+def test_run_batch_records_unreadable_files_and_continues(tmp_path):
+    good = write_wav(tmp_path / "good.wav", 0.2)
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_text(f"{good}\n{tmp_path / 'missing.wav'}\n")
+    out = tmp_path / "results.jsonl"
+
+    make_pipeline().run_batch(str(manifest), str(out))
+
+    records = {r["audio_file"]: r for r in read_records(out)}
+    assert records["good.wav"]["stt"] == "hello"
+    assert "error" in records["missing.wav"]
+
+
+def test_run_batch_with_llm(tmp_path):
+    write_wav(tmp_path / "speech.wav", 0.2)
+    write_wav(tmp_path / "silence.wav", 0.1)
+    out = tmp_path / "results.jsonl"
+
+    # Only the longer clip "has speech"; silent clips skip the LLM
+    pipeline = make_pipeline(texts_for=lambda audio: "hello" if len(audio) > SAMPLE_RATE * 0.15 else "")
+    pipeline.run_batch(str(tmp_path), str(out), with_llm=True)
+
+    records = {r["audio_file"]: r for r in read_records(out)}
+    assert records["speech.wav"]["llm"] == "hello back"
+    assert "llm" not in records["silence.wav"]
+
+
+@pytest.mark.parametrize("reply", [None, "", "   "])
+def test_empty_llm_reply_is_an_error_and_retried(tmp_path, reply):
+    clip = write_wav(tmp_path / "clip.wav", 0.2)
+    out = tmp_path / "results.jsonl"
+
+    make_pipeline(reply=reply).run_batch(str(tmp_path), str(out), with_llm=True)
+
+    record = read_records(out)[0]
+    assert record["error"] == "LLM returned no content"
+    assert clip not in load_completed(str(out))
+
+
+def test_empty_tts_audio_is_an_error(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline_module, "process_api_tts", lambda text: "")
+    record = {"path": "/clips/a.wav", "audio_file": "a.wav", "stt": "hello"}
+
+    make_pipeline().complete_record(record, with_tts=True, tts_dir=str(tmp_path))
+
+    assert record["error"] == "TTS returned no audio"
+    assert os.listdir(tmp_path) == []
+
+
+def test_tts_files_do_not_collide_for_same_basename(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline_module, "process_api_tts", lambda text: "YXVkaW8=")
+    pipeline = make_pipeline()
+    first = {"path": "/day1/a.wav", "audio_file": "a.wav", "stt": "hello"}
+    second = {"path": "/day2/a.wav", "audio_file": "a.wav", "stt": "hello"}
+
+    pipeline.complete_record(first, with_tts=True, tts_dir=str(tmp_path))
+    pipeline.complete_record(second, with_tts=True, tts_dir=str(tmp_path))
+
+    assert first["tts_file"] != second["tts_file"]
+    assert "error" not in first and "tts" not in first
+    assert len(os.listdir(tmp_path)) == 2
@@ -0,0 +1,94 @@
+import asyncio
+import collections
+import contextlib
+import time
+
+import pytest
+
+from app.services import profiling_service
+from app.services.profiling_service import LoopMonitor, TorchProfilerHook, to_collapsed, to_speedscope
+
+
+def test_speedscope_weights_match_measured_duration():
+    stack = (("main", "app.py", 1), ("work", "app.py", 10))
+    profile = {
+        "duration": 2.0,
+        "interval": 0.01,
+        # 100 passes in 2s: the real period is 20ms, not the nominal 10ms
+        "samples": 100,
+        "threads": {"MainThread": collections.Counter({stack: 60, stack[:1]: 40})},
+    }
+
+    result = to_speedscope(profile)
+
+    thread_profile = result["profiles"][0]
+    assert thread_profile["endValue"] == pytest.approx(2.0)
+    assert sum(thread_profile["weights"]) == pytest.approx(profile["duration"])
+    assert [f["name"] for f in result["shared"]["frames"]] == ["main", "work"]
+    assert "MainThread;main (app.py:1);work (app.py:10) 60" in to_collapsed(profile)
+
+
+def test_loop_monitor_records_full_stall_duration():
+    async def run():
+        monitor = LoopMonitor(interval=0.02, slow_threshold=0.05)
+        monitor.start()
+        await asyncio.sleep(0.1)
+        time.sleep(0.4)  # block the loop
+        await asyncio.sleep(0.1)
+        monitor.stop()
+        return monitor.stats()
+
+    stats = asyncio.run(run())
+
+    stall = stats["slow_callbacks"][0]
+    assert stall["detected_after_ms"] < 300
+    assert stall["blocked_ms"] >= 350
+    assert any("time.sleep(0.4)" in line for line in stall["stack"])
+
+
+def test_loop_monitor_fills_duration_when_loop_wakes_first():
+    monitor = LoopMonitor(interval=0.02, slow_threshold=0.05)
+    entry = {"blocked_ms": None}
+    monitor._open_stall = (1.0, entry)
+
+    monitor._close_stall(entry, 0.25)
+    monitor._close_stall(entry, 0.5)
+
+    assert entry["blocked_ms"] == 250.0
+    assert monitor._open_stall is None
+
+
+def test_torch_profiler_unarmed_is_a_noop():
+    hook = TorchProfilerHook()
+    assert isinstance(hook.profile("x"), contextlib.nullcontext)
+
+
+def test_torch_profiler_failure_does_not_break_transcription(tmp_path, monkeypatch):
+    def broken_profile(**kwargs):
+        raise RuntimeError("kineto unavailable")
+
+    monkeypatch.setattr(profiling_service.torch.profiler, "profile", broken_profile)
+    hook = TorchProfilerHook(output_dir=str(tmp_path))
+    hook.arm(1)
+
+    with hook.profile("transcribe"):
+        result = "transcript"
+
+    assert result == "transcript"
+    assert list(hook.traces) == []
+    # The lock is released, so the next armed call can profile again
+    assert hook._active.acquire(blocking=False)
+
+
+def test_torch_profiler_sessions_do_not_overlap(tmp_path):
+    hook = TorchProfilerHook(output_dir=str(tmp_path))
+    hook.arm(2)
+
+    first = hook.profile("a")
+    first.__enter__()
+    overlapping = hook.profile("b")
+    first.__exit__(None, None, None)
+
+    assert isinstance(overlapping, contextlib.nullcontext)
+    # The skipped call didn't use up the armed count
+    assert not isinstance(hook.profile("c"), contextlib.nullcontext)